@@ -1,13 +1,17 @@
 """ Main script that works as a dispatcher in code ocean """
 
-import json
+import itertools
 import logging
 import os
 import re
 import sys
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import lru_cache
 from glob import glob
 from pathlib import Path
-from typing import List, Tuple, Union
+from typing import List, Optional, Tuple, Union
 
 from ng_link import NgState
 
@@ -31,7 +35,100 @@ PathLike = Union[str, Path]
 PIPELINE_VERSION = "2.0.2"
 SCRIPT_DIR = Path(os.path.abspath(__file__)).parent
 
+# Absolute paths of common Code Ocean folders
+DATA_FOLDER = Path("../data").resolve()
+RESULTS_FOLDER = Path("../results").resolve()
+SCAN_MAX_WORKERS = 16
+MANIFEST_MAX_WORKERS = 8
+
+# Capsule inputs expected in the data folder per mode
+_REQUIRED_INPUTS = {
+    "dispatch": [
+        "processing_manifest.json",
+        "input_aind_metadata/data_description.json",
+    ],
+    "clean": [
+        "modified_processing_manifest.json",
+        "input_aind_metadata/data_description.json",
+    ],
+}
+
+# Channel name at the end of the step folders, e.g., Ex_488_Em_525
+_CHANNEL_RE = re.compile(r"Ex_(\d{3})_Em_(\d{3})$")
+
+
+class _Lazy:
+    """
+    Defers a function call until the object is
+    formatted. Used as a logging argument so
+    expensive messages, e.g., directory listings,
+    are only computed when the record is emitted.
+    """
 
+    def __init__(self, fn, *args):
+        self.fn = fn
+        self.args = args
+
+    def __str__(self):
+        return str(self.fn(*self.args))
+
+
+# Each wavelength bound is the upper bound to a wavelgnth band.
+# Wavelengths range from 380-750nm.
+# Color map wavelength/hex pairs are generated by sampling
+# along a CIE diagram arc.
+_CIE_BOUNDS = [
+    460,
+    470,
+    480,
+    490,
+    500,
+    520,
+    540,
+    560,
+    565,
+    575,
+    580,
+    590,
+    600,
+    620,
+    750,
+]
+_CIE_HEX = [
+    0x690AFE,  # Purple
+    0x3F2EFE,  # Blue-Purple
+    0x4B90FE,  # Blue
+    0x59D5F8,  # Blue-Green
+    0x5DF8D6,  # Green
+    0x5AFEB8,  # Green
+    0x58FEA1,  # Green
+    0x51FF1E,  # Green
+    0xBBFB01,  # Green-Yellow
+    0xE9EC02,  # Yellow
+    0xF5C503,  # Yellow-Orange
+    0xF39107,  # Orange
+    0xF15211,  # Orange-Red
+    0xF0121E,  # Red
+    0xF00050,  # Pink
+]
+
+# Upper bounds of the bands taken from the fpbase.org
+# spectra viewer, see wavelength_to_hex_alternate
+_FPBASE_BOUNDS = [500, 530, 540, 560, 580, 600, 630, 680, 700]
+_FPBASE_HEX = [
+    0x61ABFD,  # RUDDY BLUE, mTFP/mTurquoise
+    0x92FF42,  # CHARTREUSE,   EGFP
+    0xE4FE41,  # CHARTREUSE, SYFP2
+    0xF3D038,  # MUSTARD, mBanana
+    0xEAB032,  # XANTHOUS, mOrange
+    0xF15F22,  # GIANTS ORANGE, tdTomato/mScarlet
+    0xED1C24,  # RED, mCherry
+    0xC51E1F,  # FIRE ENGINE RED, mRaspberry
+    0xA81F1F,  # FIRE BRICK, mPlum
+]
+
+
+@lru_cache(maxsize=32)
 def wavelength_to_hex(wavelength: int) -> int:
     """
     Converts wavelength to corresponding color hex value.
@@ -46,33 +143,10 @@ def wavelength_to_hex(wavelength: int) -> int:
     int:
         Hex value color.
     """
-    # Each wavelength key is the upper bound to a wavelgnth band.
-    # Wavelengths range from 380-750nm.
-    # Color map wavelength/hex pairs are generated by sampling
-    # along a CIE diagram arc.
-
-    color_map = {
-        460: 0x690AFE,  # Purple
-        470: 0x3F2EFE,  # Blue-Purple
-        480: 0x4B90FE,  # Blue
-        490: 0x59D5F8,  # Blue-Green
-        500: 0x5DF8D6,  # Green
-        520: 0x5AFEB8,  # Green
-        540: 0x58FEA1,  # Green
-        560: 0x51FF1E,  # Green
-        565: 0xBBFB01,  # Green-Yellow
-        575: 0xE9EC02,  # Yellow
-        580: 0xF5C503,  # Yellow-Orange
-        590: 0xF39107,  # Orange
-        600: 0xF15211,  # Orange-Red
-        620: 0xF0121E,  # Red
-        750: 0xF00050,
-    }  # Pink
-
-    for ub, hex_val in color_map.items():
-        if wavelength < ub:  # Exclusive
-            return hex_val
-    return hex_val  # hex_val is set to the last color in for loop
+    # Exclusive upper bounds, wavelengths above
+    # the last bound get the last color
+    idx = bisect_right(_CIE_BOUNDS, wavelength)
+    return _CIE_HEX[min(idx, len(_CIE_HEX) - 1)]
 
 def str_to_bool(s:str):
     """
@@ -102,6 +176,7 @@ def str_to_bool(s:str):
     else:
         raise ValueError(f"Input should be 'true' or 'false'. Provided: {s_cleaned}")
 
+@lru_cache(maxsize=32)
 def wavelength_to_hex_alternate(wavelength: int) -> int:
     """
     Converts wavelengths to hex value, taking fpbase.org spectra viewer
@@ -128,22 +203,72 @@ def wavelength_to_hex_alternate(wavelength: int) -> int:
         Hex value color.
     """
 
-    color_map = {
-        500: 0x61ABFD,  # RUDDY BLUE, mTFP/mTurquoise
-        530: 0x92FF42,  # CHARTREUSE,   EGFP
-        540: 0xE4FE41,  # CHARTREUSE, SYFP2
-        560: 0xF3D038,  # MUSTARD, mBanana
-        580: 0xEAB032,  # XANTHOUS, mOrange
-        600: 0xF15F22,  # GIANTS ORANGE, tdTomato/mScarlet
-        630: 0xED1C24,  # RED, mCherry
-        680: 0xC51E1F,  # FIRE ENGINE RED, mRaspberry
-        700: 0xA81F1F,  # FIRE BRICK, mPlum
-    }
+    # Inclusive upper bounds, wavelengths above
+    # the last bound get the last color
+    idx = bisect_left(_FPBASE_BOUNDS, wavelength)
+    return _FPBASE_HEX[min(idx, len(_FPBASE_HEX) - 1)]
+
+
+def _find_processings(folder: PathLike) -> List[str]:
+    """
+    Finds the processing jsons inside the metadata
+    folder of a pipeline step, ignoring the
+    processing manifests.
+
+    Parameters
+    ----------
+    folder: PathLike
+        Folder generated by a pipeline step
+
+    Returns
+    -------
+    List[str]
+        Paths of the processing jsons
+    """
+    try:
+        with os.scandir(f"{folder}/metadata") as entries:
+            return [
+                entry.path
+                for entry in entries
+                # Matching glob's '*processing*.json', which
+                # follows symlinks and skips hidden files
+                if not entry.name.startswith(".")
+                and entry.is_file()
+                and "processing" in entry.name
+                and entry.name.endswith(".json")
+                and "manifest" not in entry.name
+            ]
+
+    except FileNotFoundError:
+        return []
+
+
+def _scan_processings(folders: List[PathLike]) -> List[List[str]]:
+    """
+    Looks for the processing jsons of several pipeline
+    step folders concurrently. The metadata discovery
+    is dominated by the latency of the file system,
+    so the folders are scanned in a thread pool.
+
+    Parameters
+    ----------
+    folders: List[PathLike]
+        Folders generated by a pipeline step
+
+    Returns
+    -------
+    List[List[str]]
+        Processing jsons per folder, in the
+        same order as the provided folders
+    """
+    if not len(folders):
+        return []
+
+    with ThreadPoolExecutor(
+        max_workers=min(SCAN_MAX_WORKERS, len(folders))
+    ) as executor:
+        return list(executor.map(_find_processings, folders))
 
-    for ub, hex_val in color_map.items():
-        if wavelength <= ub:  # Inclusive
-            return hex_val
-    return hex_val  # hex_val is set to the last color in for loop
 
 def dispatch(processing_manifest: dict, results_folder: PathLike):
     """
@@ -179,8 +304,11 @@ def dispatch(processing_manifest: dict, results_folder: PathLike):
         if not len(segment_channels):
             raise BaseException("Stopping pipeline, no segmentation channels.")
 
+        manifest_jobs = []
         for channel_to_segment in segment_channels:
-            copy_pipeline_config = pipeline_config.copy()
+            # Deep copy, the nested segmentation config
+            # must not be shared between channels
+            copy_pipeline_config = utils.deep_copy_dict(pipeline_config)
 
             copy_pipeline_config["segmentation"]["input_data"] = "../data/fused"
             copy_pipeline_config["segmentation"]["channel"] = channel_to_segment
@@ -194,11 +322,19 @@ def dispatch(processing_manifest: dict, results_folder: PathLike):
             copy_pipeline_config["quantification"]["channel"] = channel_to_segment
             copy_pipeline_config["quantification"]["save_path"] = "../results/"
 
-            utils.save_dict_as_json(
-                f"{results_folder}/segmentation_processing_manifest_{channel_to_segment}.json",
-                copy_pipeline_config,
+            manifest_jobs.append(
+                (
+                    f"{results_folder}/segmentation_processing_manifest_{channel_to_segment}.json",
+                    copy_pipeline_config,
+                )
             )
 
+        # Manifests are independent files, writing them concurrently
+        with ThreadPoolExecutor(
+            max_workers=min(MANIFEST_MAX_WORKERS, len(manifest_jobs))
+        ) as executor:
+            list(executor.map(lambda job: utils.save_dict_as_json(*job), manifest_jobs))
+
     else:
         raise BaseException("Stopping pipeline, pipeline configuration.")
 
@@ -230,7 +366,7 @@ def clean_up(
         False otherwise.
 
     """
-    logger.info(f"Data folder: {os.listdir(data_folder)}")
+    logger.info("Data folder: %s", _Lazy(os.listdir, data_folder))
 
     # # Variables from processing manifest
     # bucket = "aind-open-data"
@@ -241,35 +377,19 @@ def clean_up(
     logger.info(f"Cell folders: {cell_folders}")
     logger.info(f"Quantification folders: {quantification_folders}")
 
-    # Reading segmentation processings
-    segmentation_processing = []
-    for cell_folder in cell_folders:
-        processing_jsons = [
-            p
-            for p in glob(f"{cell_folder}/metadata/*processing*.json")
-            if "manifest" not in str(p)
-        ]
-        segmentation_processing.append(processing_jsons)
-
-    # Reading quantification processings
-    quantification_processing = []
-    for quant_folder in quantification_folders:
-        processing_jsons = [
-            p
-            for p in glob(f"{quant_folder}/metadata/*processing*.json")
-            if "manifest" not in str(p)
-        ]
-        quantification_processing.append(processing_jsons)
+    # Reading segmentation and quantification processings,
+    # segmentation goes first
+    step_processings = _scan_processings(cell_folders + quantification_folders)
 
     # Building from previous processing json
-    processing_paths = list()
-    combined_processing_list = (
-        [[f"{data_folder}/output_aind_metadata/processing.json"]]
-        + segmentation_processing
-        + quantification_processing
-    )
-    for sub_list in combined_processing_list:
-        processing_paths += sub_list
+    processing_paths = [
+        processing_path
+        for processing_jsons in itertools.chain(
+            [[f"{data_folder}/output_aind_metadata/processing.json"]],
+            step_processings,
+        )
+        for processing_path in processing_jsons
+    ]
 
     logger.info(f"Compiling processing paths: {processing_paths}")
     output_filename = utils.compile_processing_jsons(
@@ -281,73 +401,76 @@ def clean_up(
 
     logger.info(f"Compiled processing.json in path {output_filename}")
 
-    # Moving data out
+    # Defining outputs, used by both the cloud and local
+    # modes and reported in the output txt files
+    s3_path = processing_manifest["pipeline_processing"]["stitching"]["s3_path"]
+    cell_s3_output = f"{s3_path}/image_cell_segmentation"
+    quantification_s3_output = f"{s3_path}/image_cell_quantification"
 
-    if cloud_mode:
-        # Defining s3 outputs
-        s3_path = processing_manifest["pipeline_processing"]["stitching"]["s3_path"]
-        cell_s3_output = f"{s3_path}/image_cell_segmentation"
-        quantification_s3_output = f"{s3_path}/image_cell_quantification"
+    # Resolving the channel of every folder once
+    cell_jobs = [
+        (cell_folder, _CHANNEL_RE.search(os.path.basename(cell_folder)).group())
+        for cell_folder in cell_folders
+    ]
+    quantification_jobs = [
+        (
+            quantification_folder,
+            _CHANNEL_RE.search(os.path.basename(quantification_folder)).group(),
+        )
+        for quantification_folder in quantification_folders
+    ]
 
-        regex_channels = r"Ex_(\d{3})_Em_(\d{3})$"
+    # Moving data out
 
-        # Copying final processing manifest
-        for out in utils.execute_command_helper(
-            f"aws s3 mv {results_folder}/processing.json {s3_path}/processing.json"
-        ):
-            print(out)
+    if cloud_mode:
+        # Moving final processing manifest
+        utils.upload_file_to_s3(
+            f"{results_folder}/processing.json",
+            f"{s3_path}/processing.json",
+            delete_source=True,
+        )
 
         # Moving data to the cell folder
-        for cell_folder in cell_folders:
-            channel_name = re.search(regex_channels, cell_folder).group()
+        for cell_folder, channel_name in cell_jobs:
 
-            for out in utils.execute_command_helper(
-                f"aws s3 mv --recursive {cell_folder} {cell_s3_output}/{channel_name}"
-            ):
-                print(out)
+            utils.upload_folder_to_s3(
+                cell_folder, f"{cell_s3_output}/{channel_name}", delete_source=True
+            )
 
         # Moving data to the quantification folder
-        for quantification_folder in quantification_folders:
-            channel_name = re.search(regex_channels, quantification_folder).group()
+        for quantification_folder, channel_name in quantification_jobs:
 
-            for out in utils.execute_command_helper(
-                f"aws s3 mv --recursive {quantification_folder} {quantification_s3_output}/{channel_name}"
-            ):
-                print(out)
+            utils.upload_folder_to_s3(
+                quantification_folder,
+                f"{quantification_s3_output}/{channel_name}",
+                delete_source=True,
+            )
     
     else:
         # Move the data locally
-        s3_path = processing_manifest["pipeline_processing"]["stitching"]["s3_path"]
-        cell_s3_output = f"{s3_path}/image_cell_segmentation"
-        quantification_s3_output = f"{s3_path}/image_cell_quantification"
-
-        regex_channels = r"Ex_(\d{3})_Em_(\d{3})$"
-
         # Copying final processing manifest
         for out in utils.execute_command_helper(
-            f"mv {results_folder}/processing.json {s3_path}/processing.json"
+            ["mv", f"{results_folder}/processing.json", f"{s3_path}/processing.json"]
         ):
             print(out)
 
         # Moving data to the cell folder
-        for cell_folder in cell_folders:
-            channel_name = re.search(regex_channels, cell_folder).group()
+        for cell_folder, channel_name in cell_jobs:
             dest_folder = f"{cell_s3_output}/{channel_name}"
             utils.create_folder(dest_folder, verbose=True)
 
             for out in utils.execute_command_helper(
-                f"mv {cell_folder}/* {dest_folder}/"
+                f"mv {cell_folder}/* {dest_folder}/", quiet=True
             ):
                 print(out)
 
         # Moving data to the quantification folder
-        for quantification_folder in quantification_folders:
-            channel_name = re.search(regex_channels, quantification_folder).group()
+        for quantification_folder, channel_name in quantification_jobs:
             dest_folder = f"{quantification_s3_output}/{channel_name}"
             utils.create_folder(dest_folder, verbose=True)
 
             for out in utils.execute_command_helper(
-                f"mv {quantification_folder}/* {dest_folder}/"
+                f"mv {quantification_folder}/* {dest_folder}/", quiet=True
             ):
                 print(out)
 
@@ -398,8 +521,9 @@ def get_data_config(
     # Doing this because of Code Ocean, ideally we would have
     # a single dataset in the pipeline
 
-    processing_manifest_path = Path(f"{data_folder}/{processing_manifest_path}")
-    data_description_path = Path(f"{data_folder}/{data_description_path}")
+    data_folder = Path(data_folder)
+    processing_manifest_path = data_folder / processing_manifest_path
+    data_description_path = data_folder / data_description_path
 
     if not processing_manifest_path.exists():
         raise ValueError(
@@ -495,41 +619,18 @@ def copy_intermediate_data(
         e.g., s3://{bucket_path}/{new_dataset_name}/{output_fusion}/OMEZarr
     """
 
-    stitch_processings = []
-    fuse_processings = []
-    ccf_processings = []
-
-    for stitch_folder in stitch_folders:
-        processing_jsons = [
-            p
-            for p in glob(f"{stitch_folder}/metadata/*processing*.json")
-            if "manifest" not in str(p)
-        ]
-        stitch_processings.append(processing_jsons)
+    # Scanning the folders of all the steps at once,
+    # the order of the steps is kept in the result
+    step_processings = _scan_processings(
+        list(stitch_folders) + list(fuse_folders) + list(ccf_folders)
+    )
 
-    for fuse_folder in fuse_folders:
-        processing_jsons = [
-            p
-            for p in glob(f"{fuse_folder}/metadata/*processing*.json")
-            if "manifest" not in str(p)
-        ]
-        fuse_processings.append(processing_jsons)
-
-    for ccf_folder in ccf_folders:
-        processing_jsons = [
-            p
-            for p in glob(f"{ccf_folder}/metadata/*processing*.json")
-            if "manifest" not in str(p)
-        ]
-        ccf_processings.append(processing_jsons)
-
-    # Flattening list
-    processing_paths = list()
-    combined_processing_list = stitch_processings + fuse_processings + ccf_processings
-    for sub_list in combined_processing_list:
-        processing_paths += sub_list
-
-    processing_paths = destripe_files + processing_paths
+    # Flattening list, destripe files go first
+    processing_paths = [
+        processing_path
+        for processing_jsons in itertools.chain([destripe_files], step_processings)
+        for processing_path in processing_jsons
+    ]
     logger.info(f"Processing paths: {processing_paths}")
 
     try:
@@ -546,82 +647,96 @@ def copy_intermediate_data(
 
     logger.info(f"Compiled processing.json in path {output_filename} - Copying to cloud?: {cloud_mode}")
 
+    # Resolving sources and names of every folder once,
+    # the copies only format plain strings
+    flatfield_jobs = [
+        (os.fspath(flatfield_channel), os.path.basename(flatfield_channel))
+        for flatfield_channel in flatfield_channels
+    ]
+    fuse_jobs = [
+        (
+            os.fspath(fuse_folder),
+            f"{fuse_folder}/OMEZarr",
+            f"{fuse_folder}/metadata",
+            os.path.basename(fuse_folder),
+        )
+        for fuse_folder in fuse_folders
+    ]
+    stitch_jobs = [
+        (
+            os.fspath(stitch_folder),
+            f"{stitch_folder}/metadata",
+            os.path.basename(stitch_folder),
+        )
+        for stitch_folder in stitch_folders
+    ]
+    ccf_jobs = [
+        (
+            os.fspath(ccf_folder),
+            _CHANNEL_RE.search(os.path.basename(ccf_folder)).group(),
+        )
+        for ccf_folder in ccf_folders
+    ]
+
     if cloud_mode:
         s3_path = f"s3://{output_path}/{new_dataset_name}"
 
         # Copying derived metadata
         output_dispatch_metadata = Path(output_dispatch_metadata)
-        for out in utils.execute_command_helper(
-            f"aws s3 cp --recursive {output_dispatch_metadata} {s3_path}"
-        ):
-            logger.info(out)
+        utils.upload_folder_to_s3(output_dispatch_metadata, s3_path)
 
         # Copying out fused data
         output_fusion = "image_tile_fusing"
         dest_zarr_path = f"{s3_path}/{output_fusion}/OMEZarr"
         dest_metadata_path = f"{s3_path}/{output_fusion}/metadata"
 
-        for flatfield_channel in flatfield_channels:
-            flatfield_channel_name = Path(flatfield_channel).name
+        for flatfield_channel, flatfield_channel_name in flatfield_jobs:
             logger.info(
                 f"Copying data from {flatfield_channel} to"
                 f"{dest_metadata_path}/flatfield_correction/{flatfield_channel_name}"
             )
-            for out in utils.execute_command_helper(
-                f"aws s3 cp --recursive {flatfield_channel} {dest_metadata_path}/flatfield_correction/{flatfield_channel_name}"
-            ):
-                logger.info(out)
+            utils.upload_folder_to_s3(
+                flatfield_channel,
+                f"{dest_metadata_path}/flatfield_correction/{flatfield_channel_name}",
+            )
 
-        for fuse_folder in fuse_folders:
+        for fuse_folder, source_zarr, source_metadata, fuse_name in fuse_jobs:
             logger.info(f"Copying data from {fuse_folder} to {s3_path}/{output_fusion}")
-            fuse_folder = Path(fuse_folder)
-            source_zarr = fuse_folder.joinpath("OMEZarr")
-            source_metadata = fuse_folder.joinpath("metadata")
 
-            if source_zarr.exists():
-                for out in utils.execute_command_helper(
-                    f"aws s3 cp --recursive {source_zarr} {dest_zarr_path}"
-                ):
-                    logger.info(out)
+            if os.path.exists(source_zarr):
+                utils.upload_folder_to_s3(source_zarr, dest_zarr_path)
 
             else:
                 raise ValueError(f"Folder {source_zarr} does not exist!")
 
-            if source_metadata.exists():
-                for out in utils.execute_command_helper(
-                    f"aws s3 cp --recursive {source_metadata} {dest_metadata_path}/{fuse_folder.name}"
-                ):
-                    logger.info(out)
+            if os.path.exists(source_metadata):
+                utils.upload_folder_to_s3(
+                    source_metadata, f"{dest_metadata_path}/{fuse_name}"
+                )
 
             else:
                 raise ValueError(f"Folder {source_metadata} does not exist!")
 
         # Copying stitch metadata
-        for stitch_folder in stitch_folders:
+        for stitch_folder, source_metadata, stitch_name in stitch_jobs:
             logger.info(f"Copying data from {stitch_folder} to {dest_metadata_path}")
-            stitch_folder = Path(stitch_folder)
-            source_metadata = stitch_folder.joinpath("metadata")
 
-            if source_metadata.exists():
-                for out in utils.execute_command_helper(
-                    f"aws s3 cp --recursive {source_metadata} {dest_metadata_path}/{stitch_folder.name}"
-                ):
-                    logger.info(out)
+            if os.path.exists(source_metadata):
+                utils.upload_folder_to_s3(
+                    source_metadata, f"{dest_metadata_path}/{stitch_name}"
+                )
 
             else:
                 raise ValueError(f"Folder {source_metadata} does not exist!")
 
         # Copying ccf data
         ccf_s3_output = f"{s3_path}/image_atlas_alignment"
-        regex_channels = r"Ex_(\d{3})_Em_(\d{3})$"
 
-        for ccf_folder in ccf_folders:
-            channel_name = re.search(regex_channels, ccf_folder).group()
+        for ccf_folder, channel_name in ccf_jobs:
 
-            for out in utils.execute_command_helper(
-                f"aws s3 mv --recursive {ccf_folder} {ccf_s3_output}/{channel_name}"
-            ):
-                logger.info(out)
+            utils.upload_folder_to_s3(
+                ccf_folder, f"{ccf_s3_output}/{channel_name}", delete_source=True
+            )
 
         utils.save_string_to_txt(
             f"Stitched dataset saved in: {s3_path}",
@@ -636,7 +751,7 @@ def copy_intermediate_data(
         # Copying derived metadata
         output_dispatch_metadata = Path(output_dispatch_metadata)
         for out in utils.execute_command_helper(
-            f"cp {output_dispatch_metadata}/*.json {s3_path}/"
+            f"cp {output_dispatch_metadata}/*.json {s3_path}/", quiet=True
         ):
             logger.info(out)
 
@@ -647,8 +762,7 @@ def copy_intermediate_data(
         utils.create_folder(dest_zarr_path, verbose=True)
         utils.create_folder(dest_metadata_path, verbose=True)
 
-        for flatfield_channel in flatfield_channels:
-            flatfield_channel_name = Path(flatfield_channel).name
+        for flatfield_channel, flatfield_channel_name in flatfield_jobs:
             dest_folder = f"{dest_metadata_path}/flatfield_correction/{flatfield_channel_name}"
             utils.create_folder(dest_folder, verbose=True)
 
@@ -657,31 +771,28 @@ def copy_intermediate_data(
                 f"{dest_folder}. Folder created!"
             )
             for out in utils.execute_command_helper(
-                f"cp {flatfield_channel}/* {dest_folder}/"
+                f"cp {flatfield_channel}/* {dest_folder}/", quiet=True
             ):
                 logger.info(out)
 
-        for fuse_folder in fuse_folders:
+        for fuse_folder, source_zarr, source_metadata, fuse_name in fuse_jobs:
             logger.info(f"Copying data from {fuse_folder} to {s3_path}/{output_fusion}")
-            fuse_folder = Path(fuse_folder)
-            source_zarr = fuse_folder.joinpath("OMEZarr")
-            source_metadata = fuse_folder.joinpath("metadata")
 
-            if source_zarr.exists():
+            if os.path.exists(source_zarr):
                 for out in utils.execute_command_helper(
-                    f"cp -r {source_zarr} {dest_zarr_path}"
+                    ["cp", "-r", source_zarr, dest_zarr_path], quiet=True
                 ):
                     logger.info(out)
 
             else:
                 raise ValueError(f"Folder {source_zarr} does not exist!")
 
-            if source_metadata.exists():
-                dest_folder = f"{dest_metadata_path}/{fuse_folder.name}"
+            if os.path.exists(source_metadata):
+                dest_folder = f"{dest_metadata_path}/{fuse_name}"
                 utils.create_folder(dest_folder, verbose=True)
 
                 for out in utils.execute_command_helper(
-                    f"cp {source_metadata}/* {dest_folder}/"
+                    f"cp {source_metadata}/* {dest_folder}/", quiet=True
                 ):
                     logger.info(out)
 
@@ -689,17 +800,15 @@ def copy_intermediate_data(
                 raise ValueError(f"Folder {source_metadata} does not exist!")
 
         # Copying stitch metadata
-        for stitch_folder in stitch_folders:
+        for stitch_folder, source_metadata, stitch_name in stitch_jobs:
             logger.info(f"Copying data from {stitch_folder} to {dest_metadata_path}")
-            stitch_folder = Path(stitch_folder)
-            source_metadata = stitch_folder.joinpath("metadata")
 
-            if source_metadata.exists():
-                dest_folder = f"{dest_metadata_path}/{stitch_folder.name}"
+            if os.path.exists(source_metadata):
+                dest_folder = f"{dest_metadata_path}/{stitch_name}"
                 utils.create_folder(dest_folder, verbose=True)
 
                 for out in utils.execute_command_helper(
-                    f"cp {source_metadata}/* {dest_folder}/"
+                    f"cp {source_metadata}/* {dest_folder}/", quiet=True
                 ):
                     logger.info(out)
 
@@ -708,15 +817,13 @@ def copy_intermediate_data(
 
         # Copying ccf data
         ccf_s3_output = f"{s3_path}/image_atlas_alignment"
-        regex_channels = r"Ex_(\d{3})_Em_(\d{3})$"
 
-        for ccf_folder in ccf_folders:
-            channel_name = re.search(regex_channels, ccf_folder).group()
+        for ccf_folder, channel_name in ccf_jobs:
             dest_folder = f"{ccf_s3_output}/{channel_name}"
             utils.create_folder(dest_folder, verbose=True)
 
             for out in utils.execute_command_helper(
-                f"cp -r {ccf_folder}/* {dest_folder}/"
+                f"cp -r {ccf_folder}/* {dest_folder}/", quiet=True
             ):
                 logger.info(out)
 
@@ -729,7 +836,10 @@ def copy_intermediate_data(
 
 
 def create_derived_stitched_metadata(
-    data_folder: PathLike, results_folder: PathLike, logger: logging.Logger
+    data_folder: PathLike,
+    results_folder: PathLike,
+    logger: logging.Logger,
+    now: Optional[datetime] = None,
 ) -> Tuple[PathLike, str]:
     """
     Creates the derived metadata following
@@ -746,6 +856,10 @@ def create_derived_stitched_metadata(
     logger: logging.Logger
         Logging object
 
+    now: Optional[datetime]
+        Creation time of the derived dataset.
+        Default None, which uses the current datetime.
+
     Returns
     -------
     Tuple[PathLike, str]
@@ -764,6 +878,7 @@ def create_derived_stitched_metadata(
         raw_data_description_path=raw_metadata_path.joinpath("data_description.json"),
         dest_data_description=output_dispatch_metadata,
         process_name="stitched",
+        now=now,
     )
 
     logger.info("Copying all available raw SmartSPIM metadata")
@@ -781,12 +896,16 @@ def create_derived_stitched_metadata(
         ],
     )
 
-    logger.info(f"Copied metadata from {raw_metadata_path}: {found_metadata}")
+    logger.info("Copied metadata from %s: %s", raw_metadata_path, found_metadata)
     logger.info(
-        f"Metadata in raw folder {raw_metadata_path}: {os.listdir(raw_metadata_path)}"
+        "Metadata in raw folder %s: %s",
+        raw_metadata_path,
+        _Lazy(os.listdir, raw_metadata_path),
     )
     logger.info(
-        f"Metadata in folder {output_dispatch_metadata}: {os.listdir(output_dispatch_metadata)}"
+        "Metadata in folder %s: %s",
+        output_dispatch_metadata,
+        _Lazy(os.listdir, output_dispatch_metadata),
     )
 
     return output_dispatch_metadata, new_dataset_name
@@ -839,23 +958,17 @@ def create_ng_link(
         "t": {"voxel_size": 0.001, "unit": "seconds"},
     }
 
-    colors = []
-    for channel_str in s3_channel_paths:
-        channel_str = Path(channel_str).stem
-        channel: int = int(channel_str.split("_")[-1])
-        hex_val: int = wavelength_to_hex_alternate(channel)
-        hex_str = f"#{str(hex(hex_val))[2:]}"
-
-        colors.append(hex_str)
-
     # Creating layer per channel
     layers = []
-    for idx in range(len(s3_channel_paths)):
-        channel_name = Path(s3_channel_paths[idx]).name
+    for s3_channel_path in s3_channel_paths:
+        channel_path = Path(s3_channel_path)
+        channel_name = channel_path.name
+        channel: int = int(channel_path.stem.split("_")[-1])
+        hex_val: int = wavelength_to_hex_alternate(channel)
 
         layers.append(
             {
-                "source": s3_channel_paths[idx],
+                "source": s3_channel_path,
                 "type": "image",
                 # use channel idx when source is the same
                 # in zarr to change channel otherwise 0
@@ -865,7 +978,7 @@ def create_ng_link(
                 "blend": "additive",
                 "tab": "rendering",
                 "shader": {
-                    "color": colors[idx],
+                    "color": f"#{hex_val:06x}",
                     "emitter": "RGB",
                     "vec": "vec3",
                 },
@@ -898,11 +1011,165 @@ def create_ng_link(
 
     ng_output_path = f"{config['output_folder']}/neuroglancer_config.json"
 
-    with open(ng_output_path, "w") as outfile:
-        json.dump(json_state, outfile, indent=2)
+    utils.save_dict_as_json(ng_output_path, json_state)
 
     return Path(ng_output_path), ng_link
 
+
+def _run_dispatch(
+    data_folder: Path, results_folder: Path, cloud_mode: bool, output_path: str
+):
+    """
+    Runs the "dispatch" mode of the capsule. It copies the
+    intermediate data, creates the neuroglancer link and
+    the processing manifests for the downstream capsules.
+
+    Parameters
+    ----------
+    data_folder: Path
+        Path pointing to the data folder
+
+    results_folder: Path
+        Path pointing to the results folder
+
+    cloud_mode: bool
+        True if the data is moved to the cloud,
+        False if it is stored locally
+
+    output_path: str
+        Path where the processed dataset is stored
+    """
+    # Single timestamp for everything generated in this run
+    now = datetime.now()
+
+    pipeline_config, dataset_name, investigators = get_data_config(
+        data_folder=data_folder,
+        data_description_path="input_aind_metadata/data_description.json",
+    )
+
+    # Creating new metadata for stitched dataset
+    output_dispatch_metadata, new_dataset_name = create_derived_stitched_metadata(
+        data_folder=data_folder, results_folder=results_folder, logger=logger, now=now
+    )
+
+    # Looking for files
+    destripe_files = glob(f"{data_folder}/image_destriping_*")
+    flatfield_channels = glob(f"{data_folder}/flatfield_correction_*")
+    stitch_folders = glob(f"{data_folder}/stitched/stitch_*")
+    fuse_folders = glob(f"{data_folder}/fused/fusion_*")
+    ccf_folders = glob(f"{data_folder}/ccf_registration_results/ccf_*")
+
+    s3_path, s3_dest_zarr = copy_intermediate_data(
+        output_dispatch_metadata=output_dispatch_metadata,
+        destripe_files=destripe_files,
+        flatfield_channels=flatfield_channels,
+        stitch_folders=stitch_folders,
+        fuse_folders=fuse_folders,
+        ccf_folders=ccf_folders,
+        new_dataset_name=new_dataset_name,
+        output_path=output_path,
+        results_folder=results_folder,
+        logger=logger,
+        cloud_mode=cloud_mode,
+    )
+
+    # Getting S3 paths for channels
+    s3_paths_for_channels = []
+    for fuse_folder in fuse_folders:
+        channel_name = f"{Path(fuse_folder).name}".replace("fusion_", "")
+        # f"{s3_path}/{output_fusion}/OMEZarr"
+        s3_paths_for_channels.append(f"{s3_dest_zarr}/{channel_name}.zarr")
+
+    axes_resolution = pipeline_config["pipeline_processing"]["stitching"][
+        "resolution"
+    ]
+    output_json, ng_link_path = create_ng_link(
+        config={
+            "bucket_path": output_path,
+            "output_folder": results_folder,
+            "ng_base_url": "https://aind-neuroglancer-sauujisjxq-uw.a.run.app",
+            "z_res": axes_resolution[2]["resolution"],
+            "y_res": axes_resolution[1]["resolution"],
+            "x_res": axes_resolution[0]["resolution"],
+        },
+        s3_channel_paths=s3_paths_for_channels,
+        s3_dataset_path=s3_path,
+    )
+
+    data_results = glob(f"{results_folder}/*")
+    logger.info(f"Data in {results_folder}: {data_results}")
+
+    # Copying neuroglancer config out
+    if cloud_mode:
+        utils.upload_file_to_s3(output_json, f"{s3_path}/{output_json.name}")
+
+    else:
+        for out in utils.execute_command_helper(
+            ["cp", str(output_json), f"{s3_path}/{output_json.name}"]
+        ):
+            logger.info(out)
+
+    # Setting the stitching path in pipeline config
+    pipeline_config["pipeline_processing"]["stitching"]["s3_path"] = s3_path
+
+    dispatch(
+        processing_manifest=pipeline_config,
+        results_folder=results_folder,
+    )
+
+    utils.save_dict_as_json(
+        f"{results_folder}/modified_processing_manifest.json",
+        pipeline_config,
+    )
+
+
+def _run_clean(
+    data_folder: Path, results_folder: Path, cloud_mode: bool, output_path: str
+):
+    """
+    Runs the "clean" mode of the capsule. It compiles the
+    final processing.json and moves the results of the
+    downstream capsules to the output path.
+
+    Parameters
+    ----------
+    data_folder: Path
+        Path pointing to the data folder
+
+    results_folder: Path
+        Path pointing to the results folder
+
+    cloud_mode: bool
+        True if the data is moved to the cloud,
+        False if it is stored locally
+
+    output_path: str
+        Path where the processed dataset is stored
+    """
+    logger.info("Starting cleaning...")
+    pipeline_config, dataset_name, investigators = get_data_config(
+        data_folder=data_folder,
+        data_description_path="input_aind_metadata/data_description.json",
+        processing_manifest_path="modified_processing_manifest.json",
+    )
+
+    pipeline_config["name"] = dataset_name
+
+    clean_up(
+        processing_manifest=pipeline_config,
+        data_folder=data_folder,
+        results_folder=results_folder,
+        cloud_mode=cloud_mode,
+    )
+
+
+# Handler of each capsule mode
+_MODES = {
+    "dispatch": _run_dispatch,
+    "clean": _run_clean,
+}
+
+
 def run():
     """
     Run function allows the smartspim pipeline to execute
@@ -928,10 +1195,6 @@ def run():
     dataset locally. Be aware we are currently using cp command.
     """
 
-    # Absolute paths of common Code Ocean folders
-    data_folder = Path(os.path.abspath("../data"))
-    results_folder = Path(os.path.abspath("../results"))
-
     params = str(sys.argv[1:])
     params = params.replace("[", "").replace("]", "").casefold()
 
@@ -942,6 +1205,7 @@ def run():
         print(f"Three parameters are required as input!, error {e}")
         exit(1)
 
+    mode = mode.strip().replace("'", '')
     cloud_mode = str_to_bool(cloud_mode)
     output_path = output_path.strip().replace("'", '')
     sys.argv = [sys.argv[0]]
@@ -951,19 +1215,21 @@ def run():
     # load_env_file = load_dotenv(dotenv_path=dotenv_path)
     # logger.info(f"Load env file status: {load_env_file}")
 
+    try:
+        run_mode = _MODES[mode]
+
+    except KeyError:
+        raise NotImplementedError(
+            f"The mode {mode} has not been implemented"
+        ) from None
+
     # It is assumed that these files
     # will be in the data folder
     required_input_elements = [
-        f"{data_folder}/processing_manifest.json",
-        f"{data_folder}/input_aind_metadata/data_description.json",
+        f"{DATA_FOLDER}/{required_input}"
+        for required_input in _REQUIRED_INPUTS[mode]
     ]
 
-    if "clean" in mode:
-        required_input_elements = [
-            f"{data_folder}/modified_processing_manifest.json",
-            f"{data_folder}/input_aind_metadata/data_description.json",
-        ]
-
     missing_files = utils.validate_capsule_inputs(required_input_elements)
 
     if len(missing_files):
@@ -971,112 +1237,15 @@ def run():
             f"We miss the following files in the capsule input: {missing_files}"
         )
 
-    logger.info(f"Data in data folder: {os.listdir(data_folder)}")
+    logger.info("Data in data folder: %s", _Lazy(os.listdir, DATA_FOLDER))
     logger.info(f"Mode: {mode} - Cloud mode: {cloud_mode} - Output path: {output_path}")
 
-    if "dispatch" in mode:
-        pipeline_config, dataset_name, investigators = get_data_config(
-            data_folder=data_folder,
-            data_description_path="input_aind_metadata/data_description.json",
-        )
-
-        # Creating new metadata for stitched dataset
-        output_dispatch_metadata, new_dataset_name = create_derived_stitched_metadata(
-            data_folder=data_folder, results_folder=results_folder, logger=logger
-        )
-
-        # Looking for files
-        destripe_files = glob(f"{data_folder}/image_destriping_*")
-        flatfield_channels = glob(f"{data_folder}/flatfield_correction_*")
-        stitch_folders = glob(f"{data_folder}/stitched/stitch_*")
-        fuse_folders = glob(f"{data_folder}/fused/fusion_*")
-        ccf_folders = glob(f"{data_folder}/ccf_registration_results/ccf_*")
-
-        s3_path, s3_dest_zarr = copy_intermediate_data(
-            output_dispatch_metadata=output_dispatch_metadata,
-            destripe_files=destripe_files,
-            flatfield_channels=flatfield_channels,
-            stitch_folders=stitch_folders,
-            fuse_folders=fuse_folders,
-            ccf_folders=ccf_folders,
-            new_dataset_name=new_dataset_name,
-            output_path=output_path,
-            results_folder=results_folder,
-            logger=logger,
-            cloud_mode=cloud_mode,
-        )
-
-        # Getting S3 paths for channels
-        s3_paths_for_channels = []
-        for fuse_folder in fuse_folders:
-            channel_name = f"{Path(fuse_folder).name}".replace("fusion_", "")
-            # f"{s3_path}/{output_fusion}/OMEZarr"
-            s3_paths_for_channels.append(f"{s3_dest_zarr}/{channel_name}.zarr")
-
-        axes_resolution = pipeline_config["pipeline_processing"]["stitching"][
-            "resolution"
-        ]
-        output_json, ng_link_path = create_ng_link(
-            config={
-                "bucket_path": output_path,
-                "output_folder": results_folder,
-                "ng_base_url": "https://aind-neuroglancer-sauujisjxq-uw.a.run.app",
-                "z_res": axes_resolution[2]["resolution"],
-                "y_res": axes_resolution[1]["resolution"],
-                "x_res": axes_resolution[0]["resolution"],
-            },
-            s3_channel_paths=s3_paths_for_channels,
-            s3_dataset_path=s3_path,
-        )
-
-        data_results = glob(f"{results_folder}/*")
-        logger.info(f"Data in {results_folder}: {data_results}")
-
-        # Copying neuroglancer config out
-        if cloud_mode:
-            for out in utils.execute_command_helper(
-                f"aws s3 cp {output_json} {s3_path}/{output_json.name}"
-            ):
-                logger.info(out)
-        
-        else:
-            for out in utils.execute_command_helper(
-                f"cp {output_json} {s3_path}/{output_json.name}"
-            ):
-                logger.info(out)
-
-        # Setting the stitching path in pipeline config
-        pipeline_config["pipeline_processing"]["stitching"]["s3_path"] = s3_path
-
-        dispatch(
-            processing_manifest=pipeline_config,
-            results_folder=results_folder,
-        )
-
-        utils.save_dict_as_json(
-            f"{results_folder}/modified_processing_manifest.json",
-            pipeline_config,
-        )
-
-    elif "clean" in mode:
-        logger.info("Starting cleaning...")
-        pipeline_config, dataset_name, investigators = get_data_config(
-            data_folder=data_folder,
-            data_description_path="input_aind_metadata/data_description.json",
-            processing_manifest_path="modified_processing_manifest.json",
-        )
-
-        pipeline_config["name"] = dataset_name
-
-        clean_up(
-            processing_manifest=pipeline_config,
-            data_folder=data_folder,
-            results_folder=results_folder,
-            cloud_mode=cloud_mode,
-        )
-
-    else:
-        raise NotImplementedError(f"The mode {mode} has not been implemented")
+    run_mode(
+        data_folder=DATA_FOLDER,
+        results_folder=RESULTS_FOLDER,
+        cloud_mode=cloud_mode,
+        output_path=output_path,
+    )
 
 
 if __name__ == "__main__":
@@ -2,14 +2,19 @@
 Utility functions
 """
 
-import json
+import io
+import mimetypes
 import os
+import shlex
 import shutil
 import subprocess
 from datetime import datetime
-from pathlib import Path
-from typing import Any, List, Optional, Union
+from functools import lru_cache
+from pathlib import Path, PurePath
+from typing import Any, List, Optional, TextIO, Tuple, Union
 
+import boto3
+import orjson
 from aind_data_schema.core.data_description import (DerivedDataDescription,
                                                     Funding)
 from aind_data_schema.core.processing import (DataProcess, PipelineProcess,
@@ -18,11 +23,23 @@ from aind_data_schema_models.modalities import Modality
 from aind_data_schema_models.organizations import Organization
 from aind_data_schema_models.pid_names import PIDName
 from aind_data_schema_models.platforms import Platform
+from botocore.config import Config
 from pydantic import TypeAdapter
+from s3transfer.manager import TransferConfig, TransferManager
 
 # IO types
 PathLike = Union[str, Path]
 
+# S3 transfer settings shared by every upload in the capsule
+S3_MAX_POOL_CONNECTIONS = 64
+S3_MAX_CONCURRENCY = 32
+S3_MULTIPART_CHUNKSIZE = 16 * 1024 * 1024
+
+# Validators are compiled once, building them walks the whole model
+_DATA_PROCESSES_ADAPTER = TypeAdapter(List[DataProcess])
+_FUNDING_ADAPTER = TypeAdapter(Funding)
+_PIDNAME_ADAPTER = TypeAdapter(PIDName)
+
 
 def copy_file(input_filename: PathLike, output_filename: PathLike):
     """
@@ -38,7 +55,9 @@ def copy_file(input_filename: PathLike, output_filename: PathLike):
     """
 
     try:
-        shutil.copy(input_filename, output_filename)
+        # Only the content is copied, on Linux Python >= 3.8
+        # does it in kernel space with os.sendfile
+        shutil.copyfile(os.fspath(input_filename), os.fspath(output_filename))
 
     except shutil.SameFileError:
         raise shutil.SameFileError(
@@ -68,18 +87,22 @@ def create_folder(dest_dir: PathLike, verbose: Optional[bool] = False) -> None:
     ------------------------
 
     OSError:
-        if the folder exists.
+        if the folder could not be created, e.g.,
+        the path exists and it is a file.
 
     """
 
-    if not (os.path.exists(dest_dir)):
-        try:
-            if verbose:
-                print(f"Creating new directory: {dest_dir}")
-            os.makedirs(dest_dir)
-        except OSError as e:
-            if e.errno != os.errno.EEXIST:
-                raise
+    try:
+        os.makedirs(dest_dir)
+
+    except FileExistsError:
+        # Only an existing file in the path is an error
+        if not os.path.isdir(dest_dir):
+            raise
+
+    else:
+        if verbose:
+            print(f"Creating new directory: {dest_dir}")
 
 
 def delete_folder(dest_dir: PathLike, verbose: Optional[bool] = False) -> None:
@@ -98,23 +121,27 @@ def delete_folder(dest_dir: PathLike, verbose: Optional[bool] = False) -> None:
     Raises
     ------------------------
 
-    shutil.Error:
-        If the folder could not be removed.
+    OSError:
+        If the folder could not be removed, e.g.,
+        because of missing permissions.
 
     """
-    if os.path.exists(dest_dir):
-        try:
-            shutil.rmtree(dest_dir)
-            if verbose:
-                print(f"Folder {dest_dir} was removed!")
-        except shutil.Error as e:
-            print(f"Folder could not be removed! Error {e}")
+    try:
+        shutil.rmtree(dest_dir)
+
+    except FileNotFoundError:
+        return
+
+    if verbose:
+        print(f"Folder {dest_dir} was removed!")
 
 
 def execute_command_helper(
-    command: str,
+    command: Union[str, List[str]],
     print_command: bool = False,
     stdout_log_file: Optional[PathLike] = None,
+    quiet: bool = False,
+    log_fh: Optional[TextIO] = None,
 ):
     """
     Execute a shell command.
@@ -122,10 +149,22 @@ def execute_command_helper(
     Parameters
     ------------------------
 
-    command: str
-        Command that we want to execute.
+    command: Union[str, List[str]]
+        Command that we want to execute. A string is run
+        through the shell, which is needed for globs, pipes
+        or redirections. A list of arguments is executed
+        directly without spawning a shell.
     print_command: bool
         Bool that dictates if we print the command in the console.
+    stdout_log_file: Optional[PathLike]
+        File where the executed command is logged.
+    quiet: bool
+        If True, the stdout of the command is discarded
+        and nothing is yielded. Default False.
+    log_fh: Optional[TextIO]
+        Already open file where the executed command and
+        its stdout lines are logged. Used instead of
+        stdout_log_file to avoid reopening the file.
 
     Raises
     ------------------------
@@ -135,19 +174,40 @@ def execute_command_helper(
 
     """
 
-    if print_command:
-        print(command)
+    use_shell = isinstance(command, str)
+    command_str = command if use_shell else shlex.join(command)
 
-    if stdout_log_file and len(str(stdout_log_file)):
-        save_string_to_txt("$ " + command, stdout_log_file, "a")
-
-    popen = subprocess.Popen(
-        command, stdout=subprocess.PIPE, universal_newlines=True, shell=True
-    )
-    for stdout_line in iter(popen.stdout.readline, ""):
-        yield str(stdout_line).strip()
-    popen.stdout.close()
-    return_code = popen.wait()
+    if print_command:
+        print(command_str)
+
+    if log_fh is not None:
+        log_fh.write("$ " + command_str + "\n")
+
+    elif stdout_log_file and len(str(stdout_log_file)):
+        save_string_to_txt("$ " + command_str, stdout_log_file, "a")
+
+    # The context manager closes the pipe and waits for the
+    # process even if the caller stops consuming the output
+    with subprocess.Popen(
+        command,
+        stdout=subprocess.DEVNULL if quiet else subprocess.PIPE,
+        bufsize=-1,
+        shell=use_shell,
+        text=True,
+        encoding="utf-8",
+        errors="replace",
+    ) as popen:
+        if not quiet:
+            # The buffered reader fetches the output in chunks
+            for stdout_line in popen.stdout:
+                stdout_line = stdout_line.rstrip("\n")
+
+                if log_fh is not None:
+                    log_fh.write(stdout_line + "\n")
+
+                yield stdout_line
+
+    return_code = popen.returncode
     if return_code:
         raise subprocess.CalledProcessError(return_code, command)
 
@@ -176,6 +236,19 @@ def execute_command(config: dict) -> None:
     # is True
     if config["info"]:
         config["logger"].info(config["command"])
+
+    elif config["exists_stdout"]:
+        # Keeping the log file open during the whole command,
+        # the writes are coalesced by the file buffer
+        with open(
+            config["stdout_log_file"], "a", buffering=io.DEFAULT_BUFFER_SIZE
+        ) as log_fh:
+            for out in execute_command_helper(
+                config["command"], config["verbose"], log_fh=log_fh
+            ):
+                if len(out):
+                    config["logger"].info(out)
+
     else:
         for out in execute_command_helper(
             config["command"], config["verbose"], config["stdout_log_file"]
@@ -183,9 +256,6 @@ def execute_command(config: dict) -> None:
             if len(out):
                 config["logger"].info(out)
 
-            if config["exists_stdout"]:
-                save_string_to_txt(out, config["stdout_log_file"], "a")
-
 
 def check_path_instance(obj: object) -> bool:
     """
@@ -204,11 +274,8 @@ def check_path_instance(obj: object) -> bool:
         True if the object is an instance of Path subclass, False otherwise.
     """
 
-    for childclass in Path.__subclasses__():
-        if isinstance(obj, childclass):
-            return True
-
-    return False
+    # PurePath is the base of every pathlib class
+    return isinstance(obj, PurePath)
 
 
 def save_dict_as_json(
@@ -234,20 +301,59 @@ def save_dict_as_json(
     if dictionary is None:
         dictionary = {}
 
-    else:
-        for key, value in dictionary.items():
-            # Converting path to str to dump dictionary into json
-            if check_path_instance(value):
-                # TODO fix the \\ encode problem in dump
-                dictionary[key] = str(value)
-
-    with open(filename, "w") as json_file:
-        json.dump(dictionary, json_file, indent=4)
+    _dump_json(dictionary, filename)
 
     if verbose:
         print(f"- Json file saved: {filename}")
 
 
+def _dump_json(dictionary: dict, filename: PathLike) -> None:
+    """
+    Writes a dictionary as a json file indented with
+    2 spaces. orjson serializes straight to bytes that
+    are written in a single call.
+    Values that are not json serializable, e.g., paths,
+    are saved as strings.
+
+    Parameters
+    ------------------------
+
+    dictionary: dict
+        Dictionary that will be saved as json.
+
+    filename: PathLike
+        Path of the json file.
+
+    """
+    Path(filename).write_bytes(
+        orjson.dumps(dictionary, default=str, option=orjson.OPT_INDENT_2)
+    )
+
+
+def deep_copy_dict(dictionary: dict) -> dict:
+    """
+    Deep copies a dictionary with json serializable
+    values by round-tripping it through json. This is
+    considerably faster than copy.deepcopy for nested
+    configuration dictionaries.
+
+    Parameters
+    ------------------------
+
+    dictionary: dict
+        Dictionary to copy.
+
+    Returns
+    ------------------------
+
+    dict:
+        Copy of the dictionary that does not share
+        nested objects with the original one.
+
+    """
+    return orjson.loads(orjson.dumps(dictionary))
+
+
 def read_json_as_dict(filepath: str) -> dict:
     """
     Reads a json as dictionary.
@@ -269,8 +375,7 @@ def read_json_as_dict(filepath: str) -> dict:
     dictionary = {}
 
     if os.path.exists(filepath):
-        with open(filepath) as json_file:
-            dictionary = json.load(json_file)
+        dictionary = orjson.loads(Path(filepath).read_bytes())
 
     return dictionary
 
@@ -324,7 +429,9 @@ def check_type_helper(value: Any, val_type: type) -> bool:
     return True
 
 
-def generate_timestamp(time_format: str = "%Y-%m-%d_%H-%M-%S") -> str:
+def generate_timestamp(
+    time_format: str = "%Y-%m-%d_%H-%M-%S", now: Optional[datetime] = None
+) -> str:
     """
     Generates a timestamp in string format.
 
@@ -334,13 +441,20 @@ def generate_timestamp(time_format: str = "%Y-%m-%d_%H-%M-%S") -> str:
         String following the conventions
         to generate the timestamp (https://strftime.org/).
 
+    now: Optional[datetime]
+        Moment to format. Default None, which
+        uses the current datetime.
+
     Returns
     ------------------------
     str:
         String with the actual datetime
         moment in string format.
     """
-    return datetime.now().strftime(time_format)
+    if now is None:
+        now = datetime.now()
+
+    return now.strftime(time_format)
 
 
 def validate_capsule_inputs(input_elements: List[str]) -> List[str]:
@@ -373,6 +487,7 @@ def generate_data_description(
     raw_data_description_path,
     dest_data_description,
     process_name: Optional[str] = "stitched",
+    now: Optional[datetime] = None,
 ):
     """
     Generates data description for the output folder.
@@ -389,6 +504,9 @@ def generate_data_description(
     process_name: str
         Process name of the new dataset
 
+    now: Optional[datetime]
+        Creation time of the new dataset. Default
+        None, which uses the current datetime.
 
     Returns
     -------------
@@ -397,8 +515,7 @@ def generate_data_description(
         data
     """
 
-    f = open(raw_data_description_path, "r")
-    data = json.load(f)
+    data = orjson.loads(Path(raw_data_description_path).read_bytes())
 
     if isinstance(data["institution"], dict) and "abbreviation" in data["institution"]:
         institution = data["institution"]["abbreviation"]
@@ -406,19 +523,22 @@ def generate_data_description(
     investigators = data["investigators"]
 
     if len(investigators) and len(investigators[0]):
-        investigators = [PIDName.parse_obj(inv) for inv in investigators]
+        investigators = [_PIDNAME_ADAPTER.validate_python(inv) for inv in investigators]
 
     else:
         investigators = [PIDName(name="Unknown")]
 
     # from_data_description
-    funding_adapter = TypeAdapter(Funding)
     funding_sources = [
-        funding_adapter.validate_python(fund) for fund in data["funding_source"]
+        _FUNDING_ADAPTER.validate_python(fund) for fund in data["funding_source"]
     ]
+
+    if now is None:
+        now = datetime.now()
+
     # Ensuring backwards compatibility
     derived = DerivedDataDescription(
-        creation_time=datetime.now(),
+        creation_time=now,
         input_data_name=data["name"],
         process_name=process_name,
         institution=Organization.from_abbreviation(institution),
@@ -433,8 +553,9 @@ def generate_data_description(
     )
 
     # derived.write_standard_file(output_directory=dest_data_description)
-    with open(f"{dest_data_description}/data_description.json", "w") as f:
-        f.write(derived.model_dump_json())
+    Path(f"{dest_data_description}/data_description.json").write_bytes(
+        derived.model_dump_json(exclude_none=True, by_alias=True).encode()
+    )
 
     return derived.name
 
@@ -467,21 +588,23 @@ def copy_available_metadata(
     """
 
     print("Files to copy: ", files_to_copy)
-    # Making sure the paths are pathlib objects
-    input_path = Path(input_path)
-    output_path = Path(output_path)
+    # Making sure the paths are strings
+    input_path = os.fspath(input_path)
+    output_path = os.fspath(output_path)
 
     found_metadata = []
 
     for metadata_filename in files_to_copy:
-        metadata_filename = input_path.joinpath(metadata_filename)
+        input_filename = os.path.join(input_path, metadata_filename)
 
-        if metadata_filename.exists():
-            found_metadata.append(metadata_filename)
+        if os.path.exists(input_filename):
+            found_metadata.append(input_filename)
 
             # Copying file to output path
-            output_filename = output_path.joinpath(metadata_filename.name)
-            copy_file(metadata_filename, output_filename)
+            output_filename = os.path.join(
+                output_path, os.path.basename(metadata_filename)
+            )
+            copy_file(input_filename, output_filename)
 
     return found_metadata
 
@@ -561,14 +684,16 @@ def compile_processing_jsons(
     str:
         Path where the processing json was saved
     """
+    # Only the data processes are validated, the rest
+    # of each processing json is not used
     data_processes = []
     for processing_path in processing_paths:
         curr_processing = read_json_as_dict(str(processing_path))
-        processing_adapter = TypeAdapter(Processing)
-        curr_processing_obj = processing_adapter.validate_python(curr_processing)
-
-        for data_process in curr_processing_obj.processing_pipeline.data_processes:
-            data_processes.append(data_process)
+        data_processes.extend(
+            _DATA_PROCESSES_ADAPTER.validate_python(
+                curr_processing["processing_pipeline"]["data_processes"]
+            )
+        )
 
     output_filename = generate_processing(
         data_processes=data_processes,
@@ -579,6 +704,203 @@ def compile_processing_jsons(
 
     return output_filename
 
+
+@lru_cache(maxsize=1)
+def get_s3_client():
+    """
+    Returns the S3 client shared by all the
+    transfers in the capsule. It is created
+    once so the connection pool is reused.
+
+    Returns
+    ------------------------
+    botocore.client.S3
+        S3 client
+    """
+    return boto3.client(
+        "s3", config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS)
+    )
+
+
+@lru_cache(maxsize=1)
+def get_s3_transfer_manager() -> TransferManager:
+    """
+    Returns the transfer manager shared by all the
+    uploads in the capsule. The manager runs the
+    uploads concurrently and splits large files in
+    multipart uploads.
+
+    Returns
+    ------------------------
+    TransferManager
+        S3 transfer manager
+    """
+    return TransferManager(
+        get_s3_client(),
+        TransferConfig(
+            max_request_concurrency=S3_MAX_CONCURRENCY,
+            multipart_chunksize=S3_MULTIPART_CHUNKSIZE,
+        ),
+    )
+
+
+def parse_s3_uri(s3_uri: str) -> Tuple[str, str]:
+    """
+    Splits a S3 uri into bucket and key prefix.
+
+    Parameters
+    ------------------------
+    s3_uri: str
+        S3 uri, e.g., s3://{bucket}/{prefix}
+
+    Returns
+    ------------------------
+    Tuple[str, str]
+        Bucket name and key prefix without
+        trailing slashes
+    """
+    path = str(s3_uri).replace("s3://", "", 1)
+    bucket, _, prefix = path.partition("/")
+    return bucket, prefix.strip("/")
+
+
+def list_files_recursively(folder: PathLike) -> List[str]:
+    """
+    Lists all the files inside of a folder
+    and its subfolders.
+
+    Parameters
+    ------------------------
+    folder: PathLike
+        Folder to walk
+
+    Returns
+    ------------------------
+    List[str]
+        Paths of the files in the folder
+    """
+    files = []
+    pending_folders = [os.fspath(folder)]
+
+    while pending_folders:
+        with os.scandir(pending_folders.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    pending_folders.append(entry.path)
+                else:
+                    files.append(entry.path)
+
+    return files
+
+
+def _guess_content_type(filename: PathLike) -> dict:
+    """
+    Guesses the content type of a file from its
+    name, as the AWS CLI does on uploads.
+
+    Parameters
+    ------------------------
+    filename: PathLike
+        File that will be uploaded
+
+    Returns
+    ------------------------
+    dict
+        Extra arguments for the upload with the
+        ContentType, empty if it could not be guessed
+    """
+    content_type, _ = mimetypes.guess_type(os.fspath(filename))
+
+    if content_type is None:
+        return {}
+
+    return {"ContentType": content_type}
+
+
+def upload_folder_to_s3(
+    local_dir: PathLike, s3_uri: str, delete_source: Optional[bool] = False
+) -> int:
+    """
+    Uploads the content of a local folder to S3
+    concurrently. Equivalent to
+    'aws s3 cp --recursive' or 'aws s3 mv --recursive'
+    when delete_source is True, including the
+    content type guessed from each filename.
+
+    Parameters
+    ------------------------
+    local_dir: PathLike
+        Folder with the data to upload
+
+    s3_uri: str
+        Destination in S3, e.g., s3://{bucket}/{prefix}
+
+    delete_source: Optional[bool]
+        True if the local files are removed once
+        they were uploaded. Default False.
+
+    Returns
+    ------------------------
+    int
+        Number of uploaded files
+    """
+    local_dir = os.fspath(local_dir)
+    bucket, prefix = parse_s3_uri(s3_uri)
+    manager = get_s3_transfer_manager()
+
+    transfers = []
+    for filename in list_files_recursively(local_dir):
+        relative_key = os.path.relpath(filename, local_dir).replace(os.sep, "/")
+        key = f"{prefix}/{relative_key}" if prefix else relative_key
+        transfers.append(
+            (
+                filename,
+                manager.upload(
+                    filename, bucket, key, extra_args=_guess_content_type(filename)
+                ),
+            )
+        )
+
+    for filename, future in transfers:
+        future.result()
+
+        if delete_source:
+            os.remove(filename)
+
+    return len(transfers)
+
+
+def upload_file_to_s3(
+    filename: PathLike, s3_uri: str, delete_source: Optional[bool] = False
+) -> None:
+    """
+    Uploads a single file to S3. Equivalent to
+    'aws s3 cp' or 'aws s3 mv' when delete_source
+    is True, including the content type guessed
+    from the filename.
+
+    Parameters
+    ------------------------
+    filename: PathLike
+        File to upload
+
+    s3_uri: str
+        Destination of the file in S3,
+        e.g., s3://{bucket}/{key}
+
+    delete_source: Optional[bool]
+        True if the local file is removed once
+        it was uploaded. Default False.
+    """
+    bucket, key = parse_s3_uri(s3_uri)
+    get_s3_client().upload_file(
+        os.fspath(filename), bucket, key, ExtraArgs=_guess_content_type(filename)
+    )
+
+    if delete_source:
+        os.remove(filename)
+
+
 def clean_investigator_names(investigators):
     """
     Formats investigator list to be syntactically correct
@@ -595,11 +917,11 @@ def clean_investigator_names(investigators):
 
     """
 
-    if len(investigators) > 1:
-        invest = ", ".join(investigators)
-        idx = invest.rfind(",")
-        invest = invest[:idx] + " and" + invest[idx + 1 :]
-    else:
+    if not len(investigators):
+        invest = ""
+    elif len(investigators) == 1:
         invest = investigators[0]
+    else:
+        invest = f"{', '.join(investigators[:-1])} and {investigators[-1]}"
 
     return invest